@@ -127,20 +127,25 @@ if __name__ == '__main__':
     class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
         pass
     class Handler(BaseHTTPRequestHandler):
-        def _set_response(self):
+        # HTTP/1.1 so that CLI clients (tts.py) can keep one connection open across requests
+        protocol_version = "HTTP/1.1"
+
+        def _set_response(self, body, content_type="text/html"):
             self.send_response(200)
-            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
             self.end_headers()
+            self.wfile.write(body)
 
         def do_GET(self):
             returnString = "[DEBUG] Get request for {}".format(self.path).encode("utf-8")
             logger.info(returnString)
-            self._set_response()
-            self.wfile.write(returnString)
+            self._set_response(returnString)
 
         def do_POST(self):
             global modelsPaths
             post_data = ""
+            audio_response = None
             try:
                 content_length = int(self.headers['Content-Length'])
                 post_data = json.loads(self.rfile.read(content_length).decode('utf-8')) if content_length else {}
@@ -313,6 +318,12 @@ if __name__ == '__main__':
 
                         plugin_manager.run_plugins(plist=plugin_manager.plugins["synth-line"]["post"], event="post synth-line", data=post_data)
 
+                        # CLI clients (tts.py) get the audio in the response, rather than sharing a folder with the server
+                        if "returnAudio" in post_data and post_data["returnAudio"] and os.path.exists(out_path):
+                            with open(out_path, "rb") as f:
+                                audio_response = f.read()
+                            os.remove(out_path)
+
 
                 if self.path == "/synthesize_batch":
                     post_data["pluginsContext"] = json.loads(post_data["pluginsContext"])
@@ -347,6 +358,15 @@ if __name__ == '__main__':
                     post_data["req_response"] = req_response
                     plugin_manager.run_plugins(plist=plugin_manager.plugins["batch-synth-line"]["post"], event="post batch-synth-line", data=post_data)
 
+                    # For CLI clients (tts.py): the WAV files back to back, in line order. Each one's RIFF header gives its size.
+                    if "returnAudio" in post_data and post_data["returnAudio"] and req_response=="" and all(os.path.exists(record[4]) for record in linesBatch):
+                        wavs = []
+                        for record in linesBatch:
+                            with open(record[4], "rb") as f:
+                                wavs.append(f.read())
+                            os.remove(record[4])
+                        audio_response = b"".join(wavs)
+
 
                 if self.path == "/runSpeechToSpeech":
                     logger.info("POST {}".format(self.path))
@@ -487,8 +507,10 @@ if __name__ == '__main__':
                     file_path = post_data["file_path"]
                     move_recorded_file(PROD, logger, models_manager, f'{"./resources/app" if PROD else "."}', file_path)
 
-                self._set_response()
-                self.wfile.write(req_response.encode("utf-8"))
+                if audio_response is not None:
+                    self._set_response(audio_response, "audio/wav")
+                else:
+                    self._set_response(req_response.encode("utf-8"))
             except Exception as e:
                 with open("./DEBUG_request.txt", "w+") as f:
                     f.write(traceback.format_exc())
@@ -496,6 +518,20 @@ if __name__ == '__main__':
                 logger.info("Post Error:\n {}".format(repr(e)))
                 print(traceback.format_exc())
                 logger.info(traceback.format_exc())
+                # Answer with an error rather than dropping the socket, which a keep-alive
+                # client can't tell apart from an idle timeout. A reply may already be
+                # half-written, so close the connection afterwards either way.
+                self.close_connection = True
+                body = repr(e).encode("utf-8")
+                try:
+                    self.send_response(500)
+                    self.send_header("Content-Type", "text/plain")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.send_header("Connection", "close")
+                    self.end_headers()
+                    self.wfile.write(body)
+                except OSError:
+                    pass  # the client has gone
 
 
     try:
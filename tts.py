@@ -2,79 +2,212 @@
 
 # xVA-Synth Text-to-Speech CLI
 # Usage: ./tts.py "text" [--gpu] [--voice NAME] [--stream]
+#        ./tts.py --daemon  (used by tts_hook.py; stop it with ./tts.py --stop)
 
 import argparse
-import glob
+import atexit
+import codecs
+import fcntl
+import hashlib
+import http.client
 import json
 import os
+import queue
+import re
 import shutil
+import signal
+import socket
 import subprocess
 import sys
-import time
-import urllib.request
+import threading
+import traceback
 
-SERVER_URL = "http://localhost:8008"
+import tts_runtime
+
+SERVER_HOST = "localhost"
+SERVER_PORT = 8008
+MODELS_DIR = "resources/app/models"
+# Played sentences are kept for reuse, keyed by voice model + text. New files are
+# written under ./resources first, then moved in atomically.
+CACHE_DIR = "./resources/tts_cache"
+CACHE_SIZE = 500
+# Most sentences sent to the server in one synthesize_batch request
+MAX_BATCH = 4
+
+# One keep-alive connection shared by every request (setDevice, loadModel, each synthesize)
+_CONN = http.client.HTTPConnection(SERVER_HOST, SERVER_PORT)
+atexit.register(_CONN.close)
+
+# Player output is discarded; opened once rather than by every Popen
+_DEVNULL = os.open(os.devnull, os.O_WRONLY)
+atexit.register(os.close, _DEVNULL)
+
+_SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?])\s+')
+
+
+# Arguments each player needs before the file to play it without a window
+PLAYER_ARGS = {"ffplay": ("-nodisp", "-autoexit"), "mpv": ("--no-video",)}
 
 
 def find_player():
+    """Command prefix for the first audio player found on PATH: its absolute path plus
+    any arguments it needs, so play_file only has to append the file."""
     for player in ("paplay", "aplay", "ffplay", "mpv"):
-        if shutil.which(player):
-            return player
+        path = shutil.which(player)
+        if path:
+            return (path,) + PLAYER_ARGS.get(player, ())
     return None
 
 
 def play_file(path, player):
-    if player == "ffplay":
-        subprocess.run(["ffplay", "-nodisp", "-autoexit", path],
-                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    elif player == "mpv":
-        subprocess.run(["mpv", "--no-video", path],
-                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    else:
-        subprocess.run([player, path],
-                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    """Start playing a file with a find_player() command and return the player process."""
+    # Our own fds are all non-inheritable, so there is nothing for the child to close;
+    # with close_fds=False and an absolute path subprocess can use posix_spawn
+    return subprocess.Popen(player + (path,), stdout=_DEVNULL, stderr=_DEVNULL,
+                            close_fds=False)
+
+
+def stop_player(proc):
+    """Stop a player, giving it a moment to release the audio device before killing it."""
+    if proc.poll() is not None:
+        return
+    proc.terminate()
+    try:
+        proc.wait(timeout=0.05)
+    except subprocess.TimeoutExpired:
+        proc.kill()
 
 
 def post(endpoint, data):
     body = json.dumps(data).encode()
-    req = urllib.request.Request(
-        f"{SERVER_URL}/{endpoint}",
-        data=body,
-        headers={"Content-Type": "application/json"},
-    )
-    with urllib.request.urlopen(req) as resp:
-        return resp.read()
+    headers = {"Content-Type": "application/json"}
+    reused = _CONN.sock is not None
+    try:
+        _CONN.request("POST", f"/{endpoint}", body=body, headers=headers)
+        response = _CONN.getresponse()
+    except ConnectionError:
+        # Nothing came back. On a kept-alive socket that means the server closed it
+        # while idle, so the request never ran and can be sent again; on a fresh
+        # connection it's a real failure. A failing request gets a 500 instead.
+        _CONN.close()
+        if not reused:
+            raise
+        _CONN.request("POST", f"/{endpoint}", body=body, headers=headers)
+        response = _CONN.getresponse()
+    content = response.read()
+    if response.status != 200:
+        raise http.client.HTTPException(f"/{endpoint} failed ({response.status}): "
+                                        f"{content.decode('utf-8', 'replace')}")
+    return content
+
+
+# Model JSON paths under MODELS_DIR, plus the mtime of every directory walked to find them
+_model_cache = {"dirs": {}, "paths": []}
+
+
+def model_jsons():
+    """Sorted model JSON paths. The tree is only walked again once one of its directories changes."""
+    try:
+        if _model_cache["dirs"] and all(os.stat(d).st_mtime_ns == mtime
+                                        for d, mtime in _model_cache["dirs"].items()):
+            return _model_cache["paths"]
+    except FileNotFoundError:
+        pass
+
+    dirs, paths = {}, []
+    pending = [MODELS_DIR]
+    while pending:
+        d = pending.pop()
+        try:
+            # Stat before listing, so a change made during the walk is caught next time
+            dirs[d] = os.stat(d).st_mtime_ns
+            with os.scandir(d) as entries:
+                for entry in entries:
+                    # Hidden files and folders are skipped, as glob did
+                    if entry.name.startswith("."):
+                        continue
+                    if entry.is_dir():
+                        pending.append(entry.path)
+                    elif entry.name.endswith(".json"):
+                        paths.append(entry.path)
+        except FileNotFoundError:
+            continue
+    paths.sort()
+    _model_cache["dirs"], _model_cache["paths"] = dirs, paths
+    return paths
 
 
 def find_model(voice):
-    matches = glob.glob(f"resources/app/models/**/*_{voice}.json", recursive=True)
-    if not matches:
-        return None, None
-    model_json = matches[0]
-    model_path = model_json[: -len(".json")]
-    return model_json, model_path
+    suffix = f"_{voice}.json"
+    for model_json in model_jsons():
+        if os.path.basename(model_json).endswith(suffix):
+            model_path = model_json[: -len(".json")]
+            return model_json, model_path
+    return None, None
 
 
 def list_voices():
-    for path in sorted(glob.glob("resources/app/models/**/*.json", recursive=True)):
+    for path in model_jsons():
         name = os.path.basename(path)[: -len(".json")]
         name = name.split("_", 1)[-1] if "_" in name else name
         print(f"  {name}")
 
 
 def load_base_emb(model_json):
+    """The voice's base speaker embedding, as the comma-separated string the server expects.
+
+    Cached next to the model as <model>.emb.csv, whose first line is the model JSON's
+    mtime, so the JSON is only parsed again after it changes.
+    """
+    cache = model_json[: -len(".json")] + ".emb.csv"
+    mtime = str(os.stat(model_json).st_mtime_ns)
+    try:
+        with open(cache) as f:
+            cached_mtime, base_emb = f.read().split("\n", 1)
+        if cached_mtime == mtime:
+            return base_emb
+    except (OSError, ValueError):
+        pass
+
     with open(model_json) as f:
         emb = json.load(f)["games"][0]["base_speaker_emb"]
-    return ",".join(str(v) for v in emb)
+    base_emb = ",".join(map(str, emb))
+    try:
+        partial = f"{cache}.{os.getpid()}"
+        with open(partial, "w") as f:
+            f.write(f"{mtime}\n{base_emb}")
+        os.replace(partial, cache)
+    except OSError:
+        pass  # e.g. a read-only models folder, so just parse the JSON every time
+    return base_emb
+
+
+def load_voice(voice, device):
+    """Load a voice on the server. Returns (model_path, base_emb), or None if there is no such voice."""
+    model_json, model_path = find_model(voice)
+    if not model_json:
+        return None
+    base_emb = load_base_emb(model_json)
 
+    post("setDevice", {"device": device})
+    post("loadModel", {
+        "outputs": None,
+        "model": model_path,
+        "modelType": "xVAPitch",
+        "base_lang": "en",
+        "pluginsContext": "{}",
+    })
+    return model_path, base_emb
 
-def synthesize(text, model_path, base_emb, device, output_file):
-    """Send one synthesis request and wait for the output file to appear."""
-    container_path = "/app/resources/" + os.path.basename(output_file)
-    post("synthesize", {
+
+def synthesize(text, model_path, base_emb, device, index=0):
+    """Synthesize one sentence and return its WAV data."""
+    audio = post("synthesize", {
         "sequence": text,
         "pace": 1.0,
-        "outfile": container_path,
+        # Server-side scratch file; the audio itself comes back in the response
+        "outfile": f"/tmp/tts_{os.getpid()}_{index}.wav",
+        "returnAudio": True,
         "vocoder": "n/a",
         "base_lang": "en",
         "base_emb": base_emb,
@@ -84,34 +217,271 @@ def synthesize(text, model_path, base_emb, device, output_file):
         "device": device,
         "pluginsContext": "{}",
     })
+    if not audio.startswith(b"RIFF"):
+        # A failed synthesis is a 500, so a plain 200 reply is a server that ignores returnAudio
+        raise http.client.HTTPException(
+            "The server replied without audio, so it predates returnAudio support; "
+            "rebuild it with `docker compose up --build -d`")
+    return audio
+
+
+def split_wavs(data):
+    """Split back-to-back WAV files apart, using the size in each RIFF header."""
+    wavs = []
+    pos = 0
+    while data.startswith(b"RIFF", pos):
+        end = pos + 8 + int.from_bytes(data[pos + 4:pos + 8], "little")
+        wavs.append(data[pos:end])
+        pos = end
+    return wavs if pos == len(data) else None
+
+
+def synthesize_batch(sentences, base_emb, index=0):
+    """Synthesize several sentences in one model pass. Returns their WAV data, or None if the batch failed."""
+    emb = [float(v) for v in base_emb.split(",")]
+    # [sequence, pitch, duration, pace, tempFileLocation, outPath, outFolder, pitch_amp, base_lang, base_emb, vc_content, vc_style]
+    lines_batch = [[text, None, None, 1.0, f"/tmp/tts_{os.getpid()}_{index + i}.wav", None, None, 1.0, "en", emb, None, None]
+                   for i, text in enumerate(sentences)]
+    audio = post("synthesize_batch", {
+        "linesBatch": lines_batch,
+        "returnAudio": True,
+        "speaker_i": None,
+        "vocoder": "n/a",
+        "outputJSON": False,
+        "useSR": False,
+        "useCleanup": False,
+        "modelType": "xVAPitch",
+        "pluginsContext": "{}",
+    })
+    wavs = split_wavs(audio)
+    return wavs if wavs is not None and len(wavs) == len(sentences) else None
+
+
+def cache_path(text, model_path):
+    key = hashlib.sha256(f"{model_path}\0{text}".encode()).hexdigest()
+    return os.path.join(CACHE_DIR, f"{key}.wav")
 
-    deadline = time.time() + 30
-    while not os.path.exists(output_file):
-        if time.time() > deadline:
-            return False
-        time.sleep(0.1)
-    return True
+
+def prune_cache():
+    """Remove the least recently used files beyond CACHE_SIZE."""
+    entries = sorted(os.scandir(CACHE_DIR), key=lambda entry: entry.stat().st_mtime)
+    for entry in entries[:-CACHE_SIZE]:
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            pass
 
 
 def split_sentences(text):
     """Split text on sentence-ending punctuation, keeping the punctuation."""
-    import re
-    parts = re.split(r'(?<=[.!?])\s+', text.strip())
+    parts = _SENTENCE_BOUNDARY.split(text.strip())
     return [p for p in parts if p.strip()]
 
 
-def speak_text(text, model_path, base_emb, device, play, player, index=0):
-    filename = f"tts_{os.getpid()}_{index}.wav"
-    output_file = f"./resources/{filename}"
-    ok = synthesize(text, model_path, base_emb, device, output_file)
-    if not ok:
-        print(f"Error: Audio file was not created for: {text!r}", file=sys.stderr)
-        return
-    if not play:
-        print(output_file)
-    else:
-        play_file(output_file, player)
-        os.remove(output_file)
+class Playback:
+    """Plays queued files on a background thread, so the next sentence is synthesized
+    while the current one plays.
+
+    interrupt() stops the current file and starts a new generation; files queued
+    for an older generation are skipped instead of played. Files are left in place,
+    as they belong to the cache.
+    """
+
+    def __init__(self, player):
+        self.player = player
+        self.generation = 0
+        self._queue = queue.Queue(maxsize=1)
+        self._lock = threading.Lock()
+        self._proc = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def put(self, path, generation=None):
+        self._queue.put((self.generation if generation is None else generation, path))
+
+    def interrupt(self):
+        with self._lock:
+            self.generation += 1
+            if self._proc is not None:
+                stop_player(self._proc)
+            return self.generation
+
+    def close(self):
+        """Wait for everything queued to finish playing."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while (item := self._queue.get()) is not None:
+            generation, path = item
+            with self._lock:
+                proc = None
+                if generation == self.generation:
+                    proc = self._proc = play_file(path, self.player)
+            if proc is not None:
+                proc.wait()
+                with self._lock:
+                    self._proc = None
+
+
+def speak_batch(sentences, model_path, base_emb, device, playback, index=0, generation=None):
+    """Synthesize whichever of the sentences aren't cached in one request, then queue them in order."""
+    paths = [None] * len(sentences)
+    missing = []
+    for i, text in enumerate(sentences):
+        if playback is not None:
+            cached = cache_path(text, model_path)
+            try:
+                os.utime(cached)  # cache hit, mark it as recently used
+                paths[i] = cached
+                continue
+            except FileNotFoundError:
+                pass
+        missing.append(i)
+
+    if missing:
+        texts = [sentences[i] for i in missing]
+        audio = synthesize_batch(texts, base_emb, index) if len(texts) > 1 else None
+        if audio is None:
+            audio = [synthesize(text, model_path, base_emb, device, index + i) for i, text in enumerate(texts)]
+        for i, wav in zip(missing, audio):
+            output_file = f"./resources/tts_{os.getpid()}_{index + i}.wav"
+            with open(output_file, "wb") as f:
+                f.write(wav)
+            if playback is None:
+                paths[i] = output_file
+            else:
+                paths[i] = cache_path(sentences[i], model_path)
+                os.makedirs(CACHE_DIR, exist_ok=True)
+                os.replace(output_file, paths[i])
+        if playback is not None:
+            prune_cache()
+
+    for path in paths:
+        if path is None:
+            continue
+        if playback is None:
+            print(path)
+        else:
+            playback.put(path, generation)
+
+
+def speak_sentences(sentences, model_path, base_emb, device, playback, index=0, generation=None):
+    """Speak sentences in order and return the next free file index.
+
+    The first sentence goes alone so that playback starts as soon as possible; the rest
+    go MAX_BATCH at a time, each batch being synthesized while the previous one plays.
+    Stops early if the playback is interrupted.
+    """
+    batches = [sentences[:1]] + [sentences[i:i + MAX_BATCH] for i in range(1, len(sentences), MAX_BATCH)]
+    for batch in batches:
+        if not batch or (playback is not None and generation is not None and generation != playback.generation):
+            break
+        speak_batch(batch, model_path, base_emb, device, playback, index, generation)
+        index += len(batch)
+    return index
+
+
+# ---------------------------------------------------------------------------
+# Daemon — speaks tts_hook.py requests in the background
+# ---------------------------------------------------------------------------
+
+def _speak_requests(requests, playback):
+    index = 0
+    while True:
+        generation, request = requests.get()
+        if generation != playback.generation:
+            continue
+        voice, device = request["voice"], request["device"]
+        try:
+            # Load the voice for every request: other clients (an interactive tts.py,
+            # the app) share the server's model, and the server skips an unchanged one
+            model = load_voice(voice, device)
+            if model is None:
+                print(f"Error: Voice '{voice}' not found", file=sys.stderr)
+                continue
+            model_path, base_emb = model
+            index = speak_sentences(split_sentences(request["text"]), model_path, base_emb, device,
+                                    playback, index, generation)
+        except (OSError, http.client.HTTPException) as e:
+            print(f"Error: {e!r}", file=sys.stderr)
+        except Exception:
+            # e.g. a malformed model JSON; this is the only thread that speaks, so keep it alive
+            traceback.print_exc()
+
+
+def run_daemon(player):
+    """Speak requests sent to the daemon socket until stopped. Each request is a JSON object
+    with text, voice and device, and interrupts whatever is still being spoken."""
+    # Hooks that fire together can each start a daemon. Only the one holding the pid
+    # file lock may touch the socket, so a second one can't unlink the first's.
+    socket_path = tts_runtime.socket_path()
+    pid_fd = os.open(tts_runtime.pid_path(), os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(pid_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        print("Error: A TTS daemon is already running", file=sys.stderr)
+        sys.exit(1)
+    # Not O_TRUNC or a rename: the first would wipe a running daemon's pid before the
+    # lock is checked, the second would leave the lock on an unlinked file
+    os.ftruncate(pid_fd, 0)
+    os.write(pid_fd, str(os.getpid()).encode())
+    if os.path.exists(socket_path):
+        os.remove(socket_path)  # left behind by a daemon that was killed
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen()
+
+    playback = Playback(player)
+    requests = queue.Queue()
+    threading.Thread(target=_speak_requests, args=(requests, playback), daemon=True).start()
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            conn, _ = server.accept()
+            with conn, conn.makefile("rb") as f:
+                data = f.read()
+            try:
+                request = json.loads(data)
+            except json.JSONDecodeError:
+                request = None
+            if not (isinstance(request, dict)
+                    and all(isinstance(request.get(key), str) for key in ("text", "voice", "device"))):
+                print(f"Error: Ignoring malformed request {data[:200]!r}", file=sys.stderr)
+                continue
+            requests.put((playback.interrupt(), request))
+    finally:
+        # Don't leave the player running, or a dead socket and a pid that may later be
+        # reused. The pid file is emptied rather than removed, as removing it while
+        # locked would let two daemons hold locks on different files.
+        playback.interrupt()
+        server.close()
+        os.remove(socket_path)
+        os.ftruncate(pid_fd, 0)
+
+
+def stop_daemon():
+    """Ask the running daemon to exit. Returns False if there is none."""
+    try:
+        f = open(tts_runtime.pid_path())
+    except FileNotFoundError:
+        return False
+    with f:
+        # The daemon holds this lock for as long as it runs, so a pid in an unlocked
+        # file is stale and may belong to an unrelated process by now
+        try:
+            fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            return False
+        except BlockingIOError:
+            pass
+        try:
+            pid = int(f.read())
+        except ValueError:
+            return False  # still starting up
+    os.kill(pid, signal.SIGTERM)
+    return True
 
 
 def main():
@@ -124,12 +494,29 @@ def main():
     parser.add_argument("--stream", action="store_true",
                         help="Read from stdin, synthesize sentence by sentence")
     parser.add_argument("--list-voices", action="store_true")
+    parser.add_argument("--daemon", action="store_true",
+                        help="Speak text sent over a Unix socket (by tts_hook.py) until stopped")
+    parser.add_argument("--stop", action="store_true", help="Stop the running --daemon")
     args = parser.parse_args()
 
     if args.list_voices:
         list_voices()
         return
 
+    if args.stop:
+        if not stop_daemon():
+            print("Error: No TTS daemon is running", file=sys.stderr)
+            sys.exit(1)
+        return
+
+    if args.daemon:
+        player = find_player()
+        if not player:
+            print("Error: No audio player found (paplay/aplay/ffplay/mpv)", file=sys.stderr)
+            sys.exit(1)
+        run_daemon(player)
+        return
+
     # Determine text source
     if args.stream or (args.text is None and not sys.stdin.isatty()):
         text_sentences = None  # read from stdin below
@@ -141,53 +528,66 @@ def main():
         list_voices()
         sys.exit(1)
 
-    model_json, model_path = find_model(args.voice)
-    if not model_json:
-        print(f"Error: Voice '{args.voice}' not found", file=sys.stderr)
-        print("Available voices:", file=sys.stderr)
-        list_voices()
-        sys.exit(1)
-
-    base_emb = load_base_emb(model_json)
     player = find_player() if args.play else None
     if args.play and not player:
         print("Error: No audio player found (paplay/aplay/ffplay/mpv)", file=sys.stderr)
         sys.exit(1)
 
-    post("setDevice", {"device": args.device})
-    post("loadModel", {
-        "outputs": None,
-        "model": model_path,
-        "modelType": "xVAPitch",
-        "base_lang": "en",
-        "pluginsContext": "{}",
-    })
+    model = load_voice(args.voice, args.device)
+    if model is None:
+        print(f"Error: Voice '{args.voice}' not found", file=sys.stderr)
+        print("Available voices:", file=sys.stderr)
+        list_voices()
+        sys.exit(1)
+    model_path, base_emb = model
+
+    playback = Playback(player) if args.play else None
 
     if text_sentences is not None:
         # Single arg mode
-        for i, sentence in enumerate(split_sentences(text_sentences[0])):
-            speak_text(sentence, model_path, base_emb, args.device, args.play, player, i)
+        speak_sentences(split_sentences(text_sentences[0]), model_path, base_emb, args.device, playback)
     else:
-        # Streaming stdin mode: synthesize each sentence as it arrives
-        buffer = ""
+        # Streaming stdin mode: synthesize each sentence as it arrives.
+        # Read the raw fd so partial lines are seen as soon as they're written.
+        # Text since the last sentence boundary, kept as pieces so a long unpunctuated
+        # run isn't copied again for every chunk; only joined once a boundary arrives
+        pending = []
         index = 0
-        import re
-        for line in sys.stdin:
-            buffer += line
-            # Flush on sentence boundaries
-            while re.search(r'[.!?]\s', buffer):
-                match = re.search(r'(?<=[.!?])\s+', buffer)
-                if not match:
-                    break
-                sentence = buffer[:match.start() + 1].strip()
-                buffer = buffer[match.end():]
+        stdin_fd = sys.stdin.fileno()
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        while chunk := os.read(stdin_fd, 65536):
+            text = decoder.decode(chunk)
+            # The pending text holds no boundary, so one can only end in the new text
+            # (the lookbehind still needs the last pending character)
+            tail = pending[-1][-1:] if pending else ""
+            if not _SENTENCE_BOUNDARY.search(tail + text):
+                if text:
+                    pending.append(text)
+                continue
+            scan_from = sum(map(len, pending))
+            buffer = "".join(pending) + text
+            # Flush on sentence boundaries; sentences that arrived together can share a batch
+            sentences = []
+            start = 0
+            for match in _SENTENCE_BOUNDARY.finditer(buffer, scan_from):
+                sentence = buffer[start:match.start()].strip()
+                start = match.end()
                 if sentence:
-                    speak_text(sentence, model_path, base_emb, args.device, args.play, player, index)
-                    index += 1
+                    sentences.append(sentence)
+            pending = [buffer[start:]] if start < len(buffer) else []
+            index = speak_sentences(sentences, model_path, base_emb, args.device, playback, index)
         # Speak any remaining text
+        buffer = "".join(pending) + decoder.decode(b"", final=True)
         if buffer.strip():
-            speak_text(buffer.strip(), model_path, base_emb, args.device, args.play, player, index)
+            speak_sentences([buffer.strip()], model_path, base_emb, args.device, playback, index)
+
+    if playback is not None:
+        playback.close()
 
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    except http.client.HTTPException as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
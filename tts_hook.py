@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 """
 Claude Code Stop hook — reads the last assistant response from the session
-transcript, strips non-prose content, and pipes it to tts.py.
+transcript, strips non-prose content, and hands it to the tts.py daemon
+(starting the daemon if it isn't running yet).
 
 Register in ~/.claude/settings.json:
   {
@@ -12,34 +13,72 @@ Register in ~/.claude/settings.json:
 """
 
 import json
+import mmap
 import os
 import re
+import socket
+import string
 import subprocess
 import sys
 import time
 
+import tts_runtime
+
 
 # ---------------------------------------------------------------------------
 # Text filtering — keep only speakable prose
 # ---------------------------------------------------------------------------
 
+_CODE_FENCE = re.compile(r'```[\s\S]*?```')
+_INLINE_CODE = re.compile(r'`[^`\n]+`')
+_HEADER = re.compile(r'^#{1,6}\s+', re.MULTILINE)
+_LINK = re.compile(r'\[([^\]]+)\]\([^\)]+\)')
+_URL = re.compile(r'https?://\S+')
+# Written to start with a literal so the regex engine can skip ahead to
+# candidate characters; \*\*{0,2} matches exactly what \*{1,3} does
+_BOLD = re.compile(r'\*\*{0,2}([^*\n]+)\*{1,3}')
+_ITALIC = re.compile(r'__{0,2}([^_\n]+)_{1,3}')
+_BULLET = re.compile(r'^\s*[-*+]\s+', re.MULTILINE)
+_NUMBERED = re.compile(r'^\s*\d+\.\s+', re.MULTILINE)
+_PATH_LINE = re.compile(r'[/~]|\.\.?/')
+_BLANK_RUN = re.compile(r'\n{3,}')
+_ASCII_LETTERS = string.ascii_letters.encode()
+
+
+def _alpha_count(s: str) -> int:
+    if s.isascii():
+        # Letters are exactly A-Z / a-z here, so count them by deleting them in one
+        # C-level pass instead of calling isalpha() per character
+        return len(s) - len(s.encode('ascii').translate(None, _ASCII_LETTERS))
+    return sum(map(str.isalpha, s))
+
+
 def strip_non_prose(text: str) -> str:
-    # Remove fenced code blocks
-    text = re.sub(r'```[\s\S]*?```', '', text)
-    # Remove inline code
-    text = re.sub(r'`[^`\n]+`', '', text)
+    # Plain conversational replies often have no markup at all; each pass below is
+    # skipped when the character its pattern must start with is absent.
+    # The order matters: code goes before anything inside it could be unwrapped,
+    # and URLs before the emphasis passes could eat into their underscores.
+    if '`' in text:
+        # Remove fenced code blocks, then inline code
+        text = _CODE_FENCE.sub('', text)
+        text = _INLINE_CODE.sub('', text)
     # Remove markdown headers (keep the text)
-    text = re.sub(r'^#{1,6}\s+', '', text, flags=re.MULTILINE)
+    if '#' in text:
+        text = _HEADER.sub('', text)
     # Remove markdown links — keep display text
-    text = re.sub(r'\[([^\]]+)\]\([^\)]+\)', r'\1', text)
+    if '[' in text:
+        text = _LINK.sub(r'\1', text)
     # Remove bare URLs
-    text = re.sub(r'https?://\S+', '', text)
+    if '://' in text:
+        text = _URL.sub('', text)
     # Remove bold / italic markers
-    text = re.sub(r'\*{1,3}([^*\n]+)\*{1,3}', r'\1', text)
-    text = re.sub(r'_{1,3}([^_\n]+)_{1,3}', r'\1', text)
+    if '*' in text:
+        text = _BOLD.sub(r'\1', text)
+    if '_' in text:
+        text = _ITALIC.sub(r'\1', text)
     # Remove list markers (bullet / numbered) but keep the text
-    text = re.sub(r'^\s*[-*+]\s+', '', text, flags=re.MULTILINE)
-    text = re.sub(r'^\s*\d+\.\s+', '', text, flags=re.MULTILINE)
+    text = _BULLET.sub('', text)
+    text = _NUMBERED.sub('', text)
 
     # Drop lines that look purely technical
     clean_lines = []
@@ -49,20 +88,20 @@ def strip_non_prose(text: str) -> str:
             clean_lines.append('')
             continue
         # File/shell paths
-        if re.match(r'^[/~]', s) or s.startswith('./') or s.startswith('../'):
+        if _PATH_LINE.match(s):
             continue
         # Shell prompts or command lines
         if s.startswith('$') or s.startswith('>') or s.startswith('#!'):
             continue
         # Lines that are mostly non-alpha (e.g. JSON, diffs)
-        alpha = sum(c.isalpha() for c in s)
+        alpha = _alpha_count(s)
         if len(s) > 5 and alpha / len(s) < 0.4:
             continue
         clean_lines.append(line)
 
     text = '\n'.join(clean_lines)
     # Collapse excess blank lines and trim
-    text = re.sub(r'\n{3,}', '\n\n', text).strip()
+    text = _BLANK_RUN.sub('\n\n', text).strip()
     return text
 
 
@@ -70,54 +109,116 @@ def strip_non_prose(text: str) -> str:
 # Transcript reading
 # ---------------------------------------------------------------------------
 
-def get_last_assistant_text(transcript_path: str) -> str | None:
+# Every assistant entry contains this, whatever the JSON writer's spacing
+_ASSISTANT = b'"assistant"'
+
+
+def _iter_lines_reversed(mm: mmap.mmap, needles: list[bytes]):
+    """Yield the lines of a mapped file that contain any of needles, last-to-first.
+
+    The transcript can grow to many MB over a long session, while only its end
+    matters; searching the mapping backwards means lines that can't matter are
+    never copied or split. needles may grow between lines.
+    """
+    end = len(mm)
+    while True:
+        hit = mm.rfind(needles[0], 0, end)
+        # The others only matter if they come later, so don't search past that
+        for needle in needles[1:]:
+            hit = max(hit, mm.rfind(needle, hit + 1, end))
+        if hit < 0:
+            return
+        start = mm.rfind(b'\n', 0, hit) + 1
+        stop = mm.find(b'\n', hit)
+        yield mm[start:stop if stop >= 0 else len(mm)]
+        end = start
+
+
+def _parse_entry(raw: bytes) -> dict | None:
     try:
-        with open(transcript_path) as f:
-            lines = f.readlines()
-    except OSError:
+        return json.loads(raw)
+    except json.JSONDecodeError:
         return None
 
-    entries = []
-    for raw in lines:
-        raw = raw.strip()
-        if not raw:
-            continue
-        try:
-            entries.append(json.loads(raw))
-        except json.JSONDecodeError:
-            continue
 
-    # Find the ID of the most recent assistant message.
-    # One logical message spans multiple entries (thinking/text/tool_use blocks),
-    # so we must collect text only from that specific message ID.
-    last_id = None
-    for entry in reversed(entries):
-        msg = entry.get('message', {})
-        if msg.get('role') == 'assistant':
-            last_id = msg.get('id')
-            if last_id:
-                break
-
-    if not last_id:
+def _message_text(msg: dict) -> list[str]:
+    content = msg.get('content', [])
+    if isinstance(content, str):
+        return [content]
+    if isinstance(content, list):
+        return [block['text'] for block in content
+                if isinstance(block, dict) and block.get('type') == 'text']
+    return []
+
+
+def get_last_assistant_text(transcript_path: str) -> str | None:
+    try:
+        with open(transcript_path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):  # ValueError: the file is empty
         return None
 
-    # Collect all text blocks from entries belonging to that message ID.
-    parts = []
-    for entry in entries:
-        msg = entry.get('message', {})
-        if msg.get('id') != last_id:
-            continue
-        content = msg.get('content', [])
-        if isinstance(content, str):
-            parts.append(content)
-        elif isinstance(content, list):
-            for block in content:
-                if isinstance(block, dict) and block.get('type') == 'text':
-                    parts.append(block['text'])
+    # Walk back to the most recent assistant message, then keep collecting its
+    # entries. One logical message spans multiple entries (thinking/text/tool_use
+    # blocks, possibly with tool results in between), so we must collect text only
+    # from that specific message ID; an earlier assistant entry with another ID
+    # means the whole message has been seen.
+    last_id = None
+    entry_parts = []
+    # Most entries are tool calls and results; only lines containing one of these
+    # can matter, and searching the raw bytes is far cheaper than parsing them
+    needles = [_ASSISTANT]
+    with mm:
+        for raw in _iter_lines_reversed(mm, needles):
+            entry = _parse_entry(raw)
+            if entry is None:
+                continue
+            msg = entry.get('message', {})
+            if not last_id:
+                if msg.get('role') == 'assistant':
+                    last_id = msg.get('id')
+                if not last_id:
+                    continue
+                needles.append(json.dumps(last_id, ensure_ascii=False).encode())
+            elif msg.get('id') != last_id:
+                if msg.get('role') == 'assistant' and msg.get('id'):
+                    break
+                continue
+            entry_parts.append(_message_text(msg))
 
+    parts = [part for entry in reversed(entry_parts) for part in entry]
     return '\n'.join(parts) if parts else None
 
 
+# ---------------------------------------------------------------------------
+# TTS daemon
+# ---------------------------------------------------------------------------
+
+def send_to_daemon(request: bytes) -> bool:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with sock:
+        try:
+            sock.connect(tts_runtime.socket_path())
+        except (FileNotFoundError, ConnectionRefusedError):
+            return False
+        sock.sendall(request)
+    return True
+
+
+def start_daemon():
+    tts_script = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'tts.py')
+    with open(tts_runtime.log_path(), 'ab') as log:
+        # Own session, so the daemon outlives this hook
+        subprocess.Popen(
+            [sys.executable, tts_script, '--daemon'],
+            stdin=subprocess.DEVNULL,
+            stdout=log,
+            stderr=log,
+            cwd=os.path.dirname(tts_script),
+            start_new_session=True,
+        )
+
+
 # ---------------------------------------------------------------------------
 # Entry point
 # ---------------------------------------------------------------------------
@@ -158,32 +259,18 @@ def main():
     if not prose:
         return
 
-    pid_file = '/tmp/xvasynth_tts.pid'
-
-    # Kill any in-progress TTS so new response always starts fresh.
-    if os.path.exists(pid_file):
-        try:
-            with open(pid_file) as f:
-                old_pid = int(f.read().strip())
-            os.kill(old_pid, 9)
-        except (ValueError, ProcessLookupError, PermissionError):
-            pass
-        os.remove(pid_file)
-
-    tts_script = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'tts.py')
-    proc = subprocess.Popen(
-        [sys.executable, tts_script, '--stream', '--voice', args.voice, f'--{args.device}'],
-        stdin=subprocess.PIPE,
-        cwd=os.path.dirname(tts_script),
-    )
-
-    with open(pid_file, 'w') as f:
-        f.write(str(proc.pid))
-
-    proc.communicate(input=prose.encode())
+    # The daemon interrupts any in-progress speech, so a new response always starts fresh.
+    request = json.dumps({'text': prose, 'voice': args.voice, 'device': args.device}).encode()
+    if send_to_daemon(request):
+        return
 
-    if os.path.exists(pid_file):
-        os.remove(pid_file)
+    start_daemon()
+    # Give it a moment to bind its socket
+    deadline = time.monotonic() + 10
+    while not send_to_daemon(request):
+        if time.monotonic() > deadline:
+            return
+        time.sleep(0.05)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,39 @@
+"""
+Where the tts.py daemon keeps its socket, pid file and log; shared by tts.py
+and tts_hook.py.
+
+The socket carries every response the hook speaks, so these live in a
+directory only the current user can reach: $XDG_RUNTIME_DIR, or else a
+private per-user directory under /tmp.
+"""
+
+import os
+import stat
+
+
+def runtime_dir() -> str:
+    path = os.environ.get('XDG_RUNTIME_DIR')
+    if path:
+        return path
+    path = f'/tmp/xvasynth-{os.getuid()}'
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    # Anyone can create this name first, so only use it if it really is ours
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise PermissionError(f'{path} is not a private directory owned by this user')
+    return path
+
+
+def socket_path() -> str:
+    return os.path.join(runtime_dir(), 'xvasynth_tts.sock')
+
+
+def pid_path() -> str:
+    return os.path.join(runtime_dir(), 'xvasynth_tts.pid')
+
+
+def log_path() -> str:
+    return os.path.join(runtime_dir(), 'xvasynth_tts.log')